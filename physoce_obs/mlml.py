@@ -194,11 +194,11 @@ Output: dictionary, pandas DataFrame or xarray DataSet with keys/variable names
             format = 'dict'
             print("Warning: pandas not installed, loading MLML data in dictionary format instead")
     
-    if format is 'dataframe':
+    if format == 'dataframe':
         # turn dictionary into pandas dataframe
         d = pd.DataFrame(d,index=dtime)
         d.index.name = 'time'
-    elif format is 'dataset':
+    elif format == 'dataset':
         # turn dictionary in xarray dataset, using dataframe as intermediate format
         d = pd.DataFrame(d,index=dtime)
         d.index.name = 'time'        
@@ -216,10 +216,10 @@ def _add_metadata_xarray(d,station,readme_file):
 Add metadata to xarray dataset. Currently this adds lat and lon coordinates and puts the contents of the readme in an attribute. For the weather data, the anemometer height is also added as a coordinate.
     """    
     
-    if station is 'seawater':
+    if station == 'seawater':
         d.coords['lon'] = -121.7915
         d.coords['lat'] = 36.8025
-    elif station is 'weather':
+    elif station == 'weather':
         d.coords['lon'] = -121.78842
         d.coords['lat'] = 36.80040
         d.coords['z'] = 3.3
@@ -1,11 +1,14 @@
+import os
+import logging
 import numpy as np
-import pandas as pd
 import xarray as xr
-from calendar import isleap
+from time import sleep
+
+logger = logging.getLogger(__name__)
 
 def get_oceancolor_dataset(year_range,lat_extent,lon_extent,netcdf_out=None,start_day=None,end_day=None,spatialresolution = '4km',
                           varname='chl_ocx',varcategory='CHL',timeresolution='DAY',mapping='L3m',file_prefix='A',
-                          opendap_dir = 'https://oceandata.sci.gsfc.nasa.gov:443/opendap/MODISA/L3SMI/'):
+                          opendap_dir = 'https://oceandata.sci.gsfc.nasa.gov:443/opendap/MODISA/L3SMI/',parallel=False,cache_dir=None,chunksizes=None):
     '''
 Extract a subset of data using the NASA Ocean Color OpenDAP server at https://oceandata.sci.gsfc.nasa.gov/opendap
 
@@ -29,6 +32,23 @@ spatialresolution = '4km' or '9km' (default '4km')
 mapping - default 'L3M'
 file_prefix - string for first part of filename before date information (default 'A')
 opendap_dir - directory containing files on server (default 'https://oceandata.sci.gsfc.nasa.gov:443/opendap/MODISA/L3SMI/'')
+parallel - if True, open and subset all files as one batch with xarray.open_mfdataset 
+           (requires dask, default False). Unlike the default file-by-file download, the 
+           whole download fails if any file cannot be opened. xarray holds a process-wide 
+           lock for remote netCDF4 reads, so with dask's default threaded scheduler the 
+           files are still read one at a time; concurrent reads need a process-based 
+           scheduler, e.g. a dask.distributed Client with processes=True.
+cache_dir - directory where the regional subset of each file is saved as a small NetCDF
+            file (optional, only used if parallel=False). Files already in this directory 
+            are read instead of being downloaded again.
+chunksizes - (time, lat, lon) chunk sizes of the variable in netcdf_out, which should match 
+             how the file will be read, e.g. (ntime,1,1) for time series at single points 
+             or (1,nlat,nlon) for daily maps (default is at most 64 x 128 x 128)
+
+Progress messages are logged to the 'physoce_obs.nasa' logger at DEBUG level. To show them:
+    import logging
+    logging.basicConfig()
+    logging.getLogger('physoce_obs.nasa').setLevel(logging.DEBUG)
     '''
     
     file_id = (mapping+'_'+timeresolution+'_'+varcategory+'_'+
@@ -42,97 +62,259 @@ opendap_dir - directory containing files on server (default 'https://oceandata.s
         all_years = np.arange(year_range[0],year_range[1]+1)
 
     # number of days in each year to be downloaded
-    ndays = np.nan*np.zeros(len(all_years))
-    for yi,year in enumerate(all_years):
-        if isleap(year):
-            nd = 366
-            ndays[yi] = 366
-        else:
-            nd = 365
-            ndays[yi] = 365
-        if (yi == 0) and start_day:
-            ndays[yi] = ndays[yi]-start_day+1
-        if (yi == len(all_years)-1) and end_day:
-            ndays[yi] = ndays[yi]-(nd-end_day)
+    all_years = np.asarray(all_years, dtype=np.int64)
+    leap = ((all_years%4 == 0) & (all_years%100 != 0)) | (all_years%400 == 0)
+    ndays = np.where(leap,366,365).astype(np.int64)
+    if start_day:
+        ndays[0] = ndays[0]-start_day+1
+    if end_day:
+        ndays[-1] = ndays[-1]-((366 if leap[-1] else 365)-end_day)
 
-    print('all_years',all_years)
-    print('ndays',ndays)
+    logger.debug('all_years %s',all_years)
+    logger.debug('ndays %s',ndays)
     
     
-    ntotal = int(sum(ndays))
+    ntotal = int(ndays.sum())
 
-    lat_extent = np.array(lat_extent)
-    lon_extent = np.array(lon_extent)
+    # extents as [min, max], whichever order they are given in
+    lat_extent = np.array([min(lat_extent),max(lat_extent)])
+    lon_extent = np.array([min(lon_extent),max(lon_extent)])
 
+    # URLs and dates of all files to be downloaded
+    file_urls = []
+    time = np.empty(ntotal, dtype='datetime64[D]')
     ti = 0
     for yi,year in enumerate(all_years):
         
         # start and end days (default entire year)
         dstart = 1
-        if isleap(year):
-            dend = 366
-        else:
-            dend = 365
-        
-        # if start or end days are specified
-        if (yi == 0) and (start_day is not None):
+        if (yi == 0) and start_day:
             dstart = start_day
-        if (yi == len(all_years)-1) and (end_day is not None):
-            dend = end_day
+        dend = dstart+ndays[yi]-1
             
-        print('dstart',dstart)
-        print('dend',dend)
-        print('start_day',start_day)
-        print('end_day',end_day)
+        logger.debug('dstart %s, dend %s, start_day %s, end_day %s',
+                     dstart,dend,start_day,end_day)
         
-        for day in np.arange(dstart,dend+1):
-            print(str(year)+', '+str(int(day)))
-            date_idstr = (str(year)+'/'+str(int(day)).zfill(3)+
-                          '/'+file_prefix+str(year)+str(int(day)).zfill(3))
-
-            file_url = opendap_dir+date_idstr+'.'+file_id+'.nc'
-
-            for i in range(10): # try 10 times
-                try:
-                    ds = xr.open_dataset(file_url)
-                    if ti==0:
-                        ii, = np.where((ds.lat >= lat_extent[0]) & 
-                                       (ds.lat <= lat_extent[1]))
-                        jj, = np.where((ds.lon >= lon_extent[0]) & 
-                                       (ds.lon <= lon_extent[1]))
-                        time = np.empty(ntotal, dtype='datetime64[D]')
-                        dsout = xr.Dataset(
-                            {varname: (('time','lat','lon'), np.nan*np.zeros([ntotal,len(ii)-1,len(jj)-1]))},
-                            {'time': time,
-                             'lat': np.array(ds.lat[ii[:-1]]),
-                             'lon': np.array(ds.lon[jj[:-1]])})
-                        dsout[varname].attrs = ds[varname].attrs
-                        dsout['lon'].attrs = ds['lon'].attrs
-                        dsout['lat'].attrs = ds['lat'].attrs
-                        dsout.attrs['notes'] = ('Created by nasa.get_oceancolor_dataset,' +
-                                                str(np.datetime64('now')))
-
-                    dsub = ds.isel(lat=slice(ii[0],ii[-1]),
-                                   lon=slice(jj[0],jj[-1]))
-                    ds.close()
-
-                    t = pd.to_datetime(str(year)+'-'+str(int(day)).zfill(3),format='%Y-%j').to_datetime64()
-                    time[ti] = t
-                    dsout[varname][ti,:,:] = dsub[varname]
-
-                    break
-                except:
-                    print(str(i+1)+'/10 could not open: '+file_url)
-            ti=ti+1
-
-    print('download finished')
+        year_str = str(year)
+        for day in range(dstart,dend+1):
+            day_str = str(day).zfill(3)
+            date_idstr = year_str+'/'+day_str+'/'+file_prefix+year_str+day_str
+            file_urls.append(opendap_dir+date_idstr+'.'+file_id+'.nc')
+
+        time[ti:ti+ndays[yi]] = np.datetime64(year_str+'-01-01')+np.arange(dstart-1,dend)
+        ti = ti+ndays[yi]
+
+    if parallel:
+        dsout = _open_mfdataset(file_urls,varname,lat_extent,lon_extent)
+    else:
+        # local files for the subset of each day, named after the remote file and region
+        cache_files = [None]*len(file_urls)
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            extent_str = '_'.join('%g' % float(x) for x in np.concatenate([lat_extent,lon_extent]))
+            cache_files = [os.path.join(cache_dir,os.path.basename(file_url)[:-3]+'_'+extent_str+'.nc')
+                           for file_url in file_urls]
+
+        # the server is only contacted for days that are not in the cache, and the 
+        # region indices and DAP constraint are found from the first of these days
+        # files are read one at a time, since netCDF-C calls are not thread-safe
+        constraint = None
+        region = {}
+        buf = None
+        for ti,file_url in enumerate(file_urls):
+            logger.debug('%s',time[ti])
+
+            cache_file = cache_files[ti]
+            if (cache_file is not None) and os.path.exists(cache_file):
+                with xr.open_dataset(cache_file) as dc:
+                    dsub = dc.load()
+            else:
+                if constraint is None:
+                    constraint,region,dsub = _find_region(file_url,varname,lat_extent,lon_extent)
+                else:
+                    dsub = _read_subset(file_url+constraint,varname,region)
+                if (dsub is not None) and (cache_file is not None):
+                    _write_cache(dsub,cache_file)
+
+            if dsub is None:
+                continue
+
+            if buf is None:
+                # coordinates, attributes and type of the region from the first day read
+                lat = dsub.lat.values
+                lon = dsub.lon.values
+                attrs = {name: dict(dsub[name].attrs) for name in [varname,'lat','lon']}
+
+                # keep the (decoded) floating point type of the source data, usually float32
+                dtype = dsub[varname].dtype
+                if not np.issubdtype(dtype,np.floating):
+                    dtype = np.float32
+                buf = np.full((ntotal,len(lat),len(lon)),np.nan,dtype=dtype)
+
+            buf[ti] = dsub[varname].values
+
+        if buf is None:
+            raise OSError('could not open any files in '+opendap_dir)
+
+        # wrap the filled array as a dataset once, after all files are read
+        dsout = xr.Dataset(
+            {varname: (('time','lat','lon'), buf)},
+            {'time': time,
+             'lat': lat,
+             'lon': lon})
+        for name in attrs:
+            dsout[name].attrs = attrs[name]
+
+    dsout.attrs['notes'] = ('Created by nasa.get_oceancolor_dataset,' +
+                            str(np.datetime64('now')))
+
+    logger.debug('download finished')
 
     dsout['time'] = time
     
     if netcdf_out is not None:
-        dsout.to_netcdf(netcdf_out)
+        if chunksizes is None:
+            chunksizes = tuple(min(n,nmax) for n,nmax in zip(dsout[varname].shape,(64,128,128)))
+        encoding = {varname: {'zlib': True,
+                              'complevel': 4,
+                              'shuffle': True,
+                              'chunksizes': chunksizes,
+                              'dtype': dsout[varname].dtype}}
+        dsout.to_netcdf(netcdf_out,format='NETCDF4',encoding=encoding)
         
     return dsout
+
+def _open_dataset(file_url,retries=3,backoff_factor=0.5):
+    '''
+Helper function to open a remote dataset, retrying with exponential backoff
+(backoff_factor*2**i seconds after the i-th failed attempt)
+
+Used by get_oceancolor_dataset(). Returns None if the file could not be opened.
+Missing files raise the same error as transient failures, so the number of 
+attempts is kept small (1.5 s of waiting in total by default) to move on quickly 
+from days without data.
+    '''
+    for i in range(retries):
+        try:
+            return xr.open_dataset(file_url)
+        except (OSError, RuntimeError) as e:
+            # only network and server errors are retried
+            logger.warning('%d/%d could not open %s: %s',i+1,retries,file_url,e)
+            if i < retries-1:
+                sleep(backoff_factor*2**i)
+    return None
+
+def _index_slice(x,extent):
+    '''
+Helper function to find the slice of a sorted (increasing or decreasing) coordinate 
+array x with values within extent, including the end points
+    '''
+    lo, hi = min(extent), max(extent)
+    if x[0] > x[-1]:
+        # decreasing, e.g. latitude from north to south
+        i0 = len(x)-np.searchsorted(x[::-1],hi,side='right')
+        i1 = len(x)-np.searchsorted(x[::-1],lo,side='left')
+    else:
+        i0 = np.searchsorted(x,lo,side='left')
+        i1 = np.searchsorted(x,hi,side='right')
+    return slice(int(i0),int(i1))
+
+def _find_region(file_url,varname,lat_extent,lon_extent):
+    '''
+Helper function to find the region within lat_extent and lon_extent in a remote 
+file, and whether the server accepts a DAP constraint expression for it
+
+Used by get_oceancolor_dataset(). Returns (constraint, region, dsub): the constraint 
+to append to file URLs ('' if the server does not accept it), the index slices still 
+to be applied after opening a file ({} if the constraint is used), and the regional 
+subset of this file. Returns (None, {}, None) if the file could not be opened.
+    '''
+    ds = _open_dataset(file_url)
+    if ds is None:
+        return None, {}, None
+
+    lat_slice = _index_slice(ds.lat.values,lat_extent)
+    lon_slice = _index_slice(ds.lon.values,lon_extent)
+    if (lat_slice.stop == lat_slice.start) or (lon_slice.stop == lon_slice.start):
+        ds.close()
+        raise ValueError('no data within lat_extent and lon_extent')
+
+    # request only the region from the server with a DAP constraint 
+    # expression (index ranges are inclusive), or subset the whole file 
+    # if the server does not accept the constraint
+    constraint = ('?{0}[{1}:1:{2}][{3}:1:{4}],lat[{1}:1:{2}],lon[{3}:1:{4}]'
+                  .format(varname,lat_slice.start,lat_slice.stop-1,
+                          lon_slice.start,lon_slice.stop-1))
+    region = {}
+    dsc = _open_dataset(file_url+constraint)
+    if dsc is None:
+        constraint = ''
+        region = {'lat': lat_slice,
+                  'lon': lon_slice}
+        dsc = ds
+    else:
+        ds.close()
+
+    dsub = dsc[[varname]].isel(**region).load()
+    dsc.close()
+    return constraint, region, dsub
+
+def _read_subset(file_url,varname,region):
+    '''
+Helper function to read the regional subset of one remote file
+
+Used by get_oceancolor_dataset(). Returns None if the file could not be opened.
+    '''
+    ds = _open_dataset(file_url)
+    if ds is None:
+        return None
+    dsub = ds[[varname]].isel(**region).load()
+    ds.close()
+    return dsub
+
+def _write_cache(dsub,cache_file):
+    '''
+Helper function to save the regional subset of one file to cache_file
+
+Used by get_oceancolor_dataset(). The subset is written to a temporary file first, 
+so that an interrupted write does not leave a truncated cache file.
+    '''
+    part_file = cache_file+'.part'
+    try:
+        dsub.to_netcdf(part_file)
+        os.replace(part_file,cache_file)
+    finally:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+
+def _open_mfdataset(file_urls,varname,lat_extent,lon_extent):
+    '''
+Helper function to open and subset all remote files as one batch with xarray.open_mfdataset
+
+Used by get_oceancolor_dataset(parallel=True). Files are concatenated along a new 
+time dimension, in the order of file_urls. Reads only run concurrently with a 
+process-based dask scheduler, since remote netCDF4 reads share a process-wide lock.
+    '''
+    lat_min, lat_max = min(lat_extent), max(lat_extent)
+    lon_min, lon_max = min(lon_extent), max(lon_extent)
+
+    def subset(ds):
+        # latitude is usually stored from north to south
+        if ds.lat.values[0] > ds.lat.values[-1]:
+            lat_slice = slice(lat_max,lat_min)
+        else:
+            lat_slice = slice(lat_min,lat_max)
+        return ds[[varname]].sel(lat=lat_slice,
+                                 lon=slice(lon_min,lon_max))
+
+    ds = xr.open_mfdataset(file_urls,preprocess=subset,concat_dim='time',
+                           combine='nested',parallel=True,
+                           chunks={'lat':512,'lon':512})
+    dsout = ds.compute()
+    ds.close()
+    dsout.attrs = {}
+    return dsout
     
 if __name__ == '__main__':
     ### Test the get_oceancolor_dataset function for different time parameters
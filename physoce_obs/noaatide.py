@@ -1,18 +1,68 @@
 import os
+import shutil
 from glob import glob
+from time import sleep
 from calendar import monthrange
+from concurrent.futures import ThreadPoolExecutor
 try:
     # For Python 3
-    from urllib.request import urlretrieve
+    from urllib.parse import urlencode
 except ImportError:
     # Fall back to Python 2 urllib
-    from urllib import urlretrieve
+    from urllib import urlencode
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 try:
     import pandas as pd
 except ImportError:
 	pass
-
-def download_6min_csv(out_file, begin_date, end_date, station, product='water_level', datum='STND', time_zone='GMT'):
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.dataset as pads
+except ImportError:
+    pads = None
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# shared session so that repeated calls to the NOAA CO-OPS API reuse
+# keep-alive connections instead of opening a new connection for every file,
+# and retry transient server errors with exponential backoff
+_RETRY = Retry(total=10, backoff_factor=0.1, status_forcelist=(500,502,503,504),
+               allowed_methods=frozenset(['GET']))
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=10,
+                                       max_retries=_RETRY))
+
+if httpx is not None:
+    class _RetryTransport(httpx.HTTPTransport):
+        '''httpx transport that retries connection errors and the server errors
+        in _RETRY.status_forcelist, with the same number of retries (_RETRY.total,
+        i.e. _RETRY.total+1 attempts) and backoff as the shared session'''
+
+        def handle_request(self, request):
+            for i in range(_RETRY.total+1):
+                last = (i == _RETRY.total)
+                try:
+                    response = super().handle_request(request)
+                except httpx.TransportError:
+                    if last:
+                        raise
+                else:
+                    if last or (response.status_code not in _RETRY.status_forcelist):
+                        return response
+                    response.close()
+                sleep(_RETRY.backoff_factor*2**i)
+
+# errors that mark a single failed download
+_DOWNLOAD_ERRORS = (OSError, requests.RequestException)
+if httpx is not None:
+    _DOWNLOAD_ERRORS = _DOWNLOAD_ERRORS+(httpx.HTTPError,)
+
+def download_6min_csv(out_file, begin_date, end_date, station, product='water_level', datum='STND', time_zone='GMT', session=None, overwrite=False):
     """Download 6 minute water level or meteorology csv file from NOAA CO-OPS website.
     Uses API described at https://api.tidesandcurrents.noaa.gov/api/prod/
 
@@ -28,38 +78,34 @@ def download_6min_csv(out_file, begin_date, end_date, station, product='water_le
         datum - string (default 'STND' for station datum, see API link for more info/options)
                 only used if product='water_level'
         time_zone - string (default 'GMT')
+        session - requests.Session or httpx.Client used for the download (default 
+                  None, uses a shared module-level requests.Session)
+        overwrite - boolean specifying whether to download the file again if
+                    out_file already exists (default False)
     """
 
+    if (not overwrite) and os.path.exists(out_file) and os.path.getsize(out_file) > 200:
+        return
+
     # Note: 6 minutes is the default interval, see https://api.tidesandcurrents.noaa.gov/api/prod/
 
     base_url = 'https://api.tidesandcurrents.noaa.gov'
+    params = {'product': product,
+              'application': 'NOS.COOPS.TAC.WL',
+              'begin_date': begin_date,
+              'end_date': end_date,
+              'station': station,
+              'time_zone': time_zone,
+              'units': 'metric',
+              'format': 'csv'}
     if product == 'water_level':
-        api_url = '/api/prod/datagetter'\
-        '?product='+product+\
-        '&application=NOS.COOPS.TAC.WL'\
-        '&begin_date='+begin_date+\
-        '&end_date='+end_date+\
-        '&station='+station+\
-        '&datum='+datum+\
-        '&time_zone='+time_zone+\
-        '&units=metric'\
-        '&format=csv'
-    else:
-        api_url = '/api/prod/datagetter'\
-        '?product='+product+\
-        '&application=NOS.COOPS.TAC.WL'\
-        '&begin_date='+begin_date+\
-        '&end_date='+end_date+\
-        '&station='+station+\
-        '&time_zone='+time_zone+\
-        '&units=metric'\
-        '&format=csv'
-
-    url = base_url+api_url
+        params['datum'] = datum
+
+    url = base_url+'/api/prod/datagetter?'+urlencode(params)
     print(url)
-    _retrieve_file(url,out_file)
+    _retrieve_file(url,out_file,session)
 
-def download_hourly_csv(out_file, begin_date, end_date, station, product='water_level', datum='STND', time_zone='GMT'):
+def download_hourly_csv(out_file, begin_date, end_date, station, product='water_level', datum='STND', time_zone='GMT', session=None, overwrite=False):
     """Download hourly water level or meteorology csv file from NOAA CO-OPS website.
     Uses API described at https://api.tidesandcurrents.noaa.gov/api/prod/
 
@@ -75,36 +121,34 @@ def download_hourly_csv(out_file, begin_date, end_date, station, product='water_
         datum - string (default 'STND' for station datum, see API link for more info/options)
                 only used if product='water_level'
         time_zone - string (default 'GMT')
+        session - requests.Session or httpx.Client used for the download (default 
+                  None, uses a shared module-level requests.Session)
+        overwrite - boolean specifying whether to download the file again if
+                    out_file already exists (default False)
     """
 
+    if (not overwrite) and os.path.exists(out_file) and os.path.getsize(out_file) > 200:
+        return
+
     base_url = 'https://api.tidesandcurrents.noaa.gov'
+    params = {'product': product,
+              'application': 'NOS.COOPS.TAC.WL',
+              'begin_date': begin_date,
+              'end_date': end_date,
+              'station': station,
+              'time_zone': time_zone,
+              'units': 'metric',
+              'format': 'csv'}
     if product == 'water_level':
-        api_url = '/api/prod/datagetter'\
-        '?product=hourly_height'\
-        '&application=NOS.COOPS.TAC.WL'\
-        '&begin_date='+begin_date+\
-        '&end_date='+end_date+\
-        '&datum='+datum+\
-        '&station='+station+\
-        '&time_zone='+time_zone+\
-        '&units=metric'\
-        '&format=csv'
+        params['product'] = 'hourly_height'
+        params['datum'] = datum
     else:
-        api_url = '/api/prod/datagetter'\
-        '?product='+product+\
-        '&application=NOS.COOPS.TAC.WL'\
-        '&begin_date='+begin_date+\
-        '&end_date='+end_date+\
-        '&station='+station+\
-        '&time_zone='+time_zone+\
-        '&units=metric'\
-        '&interval=h'\
-        '&format=csv'
-
-    url = base_url+api_url
-    _retrieve_file(url,out_file)
-
-def _retrieve_file(url,out_file):
+        params['interval'] = 'h'
+
+    url = base_url+'/api/prod/datagetter?'+urlencode(params)
+    _retrieve_file(url,out_file,session)
+
+def _retrieve_file(url,out_file,session=None):
     '''Helper function to retrieve data through NOAA CO-OPS API
 
     Used by download_hourly_csv() function. For further information on NOAA CO-OPS API calls, visit https://api.tidesandcurrents.noaa.gov/api/prod/
@@ -112,21 +156,54 @@ def _retrieve_file(url,out_file):
     Inputs:
         url - URL which makes a web service call through the API
         out_file - path and name of output file
+        session - requests.Session or httpx.Client used for the download (default 
+                  None, uses a shared module-level requests.Session)
     '''
 
-    urlretrieve(url,out_file)
+    if session is None:
+        session = _SESSION
 
-    # check whether data file is valid
-    f = open(out_file, 'r')
-    line1 = f.readline()
-    line2 = f.readline()
-    if (not line1.startswith('Date Time,')) or (line2.startswith('Error')):
-        print('Warning: not a valid file: '+out_file)
-        print(f.read()) # print error message in file
-        os.remove(out_file)
-    f.close()
+    if (httpx is not None) and isinstance(session, httpx.Client):
+        response = session.stream('GET', url)
+    else:
+        response = session.get(url, stream=True, timeout=30)
 
-def download_multiyear_csv(out_dir, years, station, product='water_level', datum='STND', time_zone='GMT'):
+    with response as r:
+        r.raise_for_status()
+        if isinstance(r, requests.Response):
+            chunks = r.iter_content(chunk_size=65536)
+        else:
+            chunks = r.iter_bytes()
+
+        # check whether data file is valid from the start of the response,
+        # so that invalid files are never written to disk
+        head = b''
+        for chunk in chunks:
+            head = head+chunk
+            if len(head) >= 256:
+                break
+        lines = head.split(b'\n',2)
+        line1 = lines[0]
+        line2 = lines[1] if len(lines) > 1 else b''
+        if (not line1.startswith(b'Date Time,')) or (line2.startswith(b'Error')):
+            print('Warning: not a valid file: '+out_file)
+            print((head+b''.join(chunks)).decode('utf-8','replace')) # print error message in file
+            return
+
+        # write to a temporary file first, so that an interrupted download
+        # is not mistaken for an existing file later
+        part_file = out_file+'.part'
+        try:
+            with open(part_file, 'wb') as fout:
+                fout.write(head)
+                for chunk in chunks:
+                    fout.write(chunk)
+            os.replace(part_file, out_file)
+        finally:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+
+def download_multiyear_csv(out_dir, years, station, product='water_level', datum='STND', time_zone='GMT', session=None, max_workers=6, overwrite=False, http2=False):
     """Download multiple one-year hourly csv files from NOAA CO-OPS website (one file per year).
     Uses API described at https://api.tidesandcurrents.noaa.gov/api/prod/
 
@@ -141,24 +218,30 @@ def download_multiyear_csv(out_dir, years, station, product='water_level', datum
                   (default 'water_level')
         datum - string (default 'STND' for station datum, see API link for more info/options)
                 only used if product='water_level'
+        session - requests.Session or httpx.Client shared by all downloads (default 
+                  None, uses a shared module-level requests.Session)
+        max_workers - number of files downloaded concurrently (default 6)
+        overwrite - boolean specifying whether to download files that already
+                    exist in out_dir (default False)
+        http2 - if True and no session is given, download all files over a single
+                HTTP/2 connection with httpx (requires httpx[http2], default False)
     """
 
-    # add trailing slash to directory name, if necessary
-    if out_dir[-1] is not ('/' or '\\'):
-        out_dir = out_dir+'/'
-
     # create directory if necessary
     if not os.path.isdir(out_dir):
         os.mkdir(out_dir)
 
     file_prefix = station+'_'+product+'_'
+    file_dates = []
     for year in years:
         out_file = os.path.join(out_dir,file_prefix+str(year)+'.csv')
         begin_date = str(year)+'0101'
         end_date = str(year)+'1231'
-        download_hourly_csv(out_file,begin_date,end_date,station,product,datum,time_zone)
+        file_dates.append((out_file,begin_date,end_date))
+
+    _download_files(download_hourly_csv,file_dates,station,product,datum,time_zone,session,max_workers,overwrite,http2)
 
-def download_multimonth_csv(out_dir, year_start, month_start, year_end, month_end, station, product='water_level', datum='STND', time_zone='GMT'):
+def download_multimonth_csv(out_dir, year_start, month_start, year_end, month_end, station, product='water_level', datum='STND', time_zone='GMT', session=None, max_workers=6, overwrite=False, http2=False):
     """Download multiple one-month csv files of 6-minute interval data from NOAA CO-OPS website (one file per month).
     Uses API described at https://api.tidesandcurrents.noaa.gov/api/prod/
 
@@ -176,12 +259,15 @@ def download_multimonth_csv(out_dir, year_start, month_start, year_end, month_en
                   (default 'water_level')
         datum - string (default 'STND' for station datum, see API link for more info/options)
                 only used if product='water_level'
+        session - requests.Session or httpx.Client shared by all downloads (default 
+                  None, uses a shared module-level requests.Session)
+        max_workers - number of files downloaded concurrently (default 6)
+        overwrite - boolean specifying whether to download files that already
+                    exist in out_dir (default False)
+        http2 - if True and no session is given, download all files over a single
+                HTTP/2 connection with httpx (requires httpx[http2], default False)
     """
 
-    # add trailing slash to directory name, if necessary
-    if out_dir[-1] is not ('/' or '\\'):
-        out_dir = out_dir+'/'
-
     # create directory if necessary
     if not os.path.isdir(out_dir):
         os.mkdir(out_dir)
@@ -190,6 +276,7 @@ def download_multimonth_csv(out_dir, year_start, month_start, year_end, month_en
 
     years = range(int(year_start),int(year_end)+1)
 
+    file_dates = []
     for year in years:
         if year == years[0]:
             mon_range = range(month_start,13)
@@ -212,7 +299,46 @@ def download_multimonth_csv(out_dir, year_start, month_start, year_end, month_en
             begin_date = str(year)+mon_str+'01'
             end_date = str(year)+mon_str+ndays_str
 
-            download_6min_csv(out_file, begin_date, end_date, station, product, datum, time_zone)
+            file_dates.append((out_file,begin_date,end_date))
+
+    _download_files(download_6min_csv,file_dates,station,product,datum,time_zone,session,max_workers,overwrite,http2)
+
+def _download_files(download_func,file_dates,station,product,datum,time_zone,session,max_workers,overwrite,http2):
+    '''Helper function to download several files concurrently through NOAA CO-OPS API
+
+    Used by download_multiyear_csv() and download_multimonth_csv() functions.
+    A failed download is reported, but does not stop the remaining downloads.
+
+    Inputs:
+        download_func - download_hourly_csv or download_6min_csv
+        file_dates - list of (out_file, begin_date, end_date) tuples
+        station, product, datum, time_zone, session, overwrite - passed to download_func
+        max_workers - number of files downloaded concurrently
+        http2 - if True and session is None, share one httpx HTTP/2 client
+    '''
+
+    client = None
+    if http2 and (session is None):
+        if httpx is None:
+            raise ImportError('httpx is required for http2=True')
+        transport = _RetryTransport(http2=True,
+                                    limits=httpx.Limits(max_keepalive_connections=10))
+        client = httpx.Client(transport=transport, timeout=30.0)
+        session = client
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(download_func,out_file,begin_date,end_date,
+                                       station,product,datum,time_zone,session,overwrite)
+                       for out_file,begin_date,end_date in file_dates]
+            for (out_file,begin_date,end_date),future in zip(file_dates,futures):
+                try:
+                    future.result()
+                except _DOWNLOAD_ERRORS as e:
+                    print('Warning: could not download '+out_file+': '+str(e))
+    finally:
+        if client is not None:
+            client.close()
 
 def csv_to_dataframe(data_dir,pattern='*.csv'):
     ''' Create pandas dataframe from directory of NOAA tide gauge csv files. Useful
@@ -222,18 +348,42 @@ def csv_to_dataframe(data_dir,pattern='*.csv'):
     Inputs:
         data_dir - path to directory where csv files are located
         pattern - pattern indicating which files to use (default '*.csv')
+
+    If pyarrow is installed, all files are parsed at once with its multithreaded
+    csv reader, otherwise (or if pyarrow cannot parse the files) each file is
+    read with pandas.
     '''
     file_list = sorted(glob(os.path.join(data_dir,pattern)))
-    df = pd.DataFrame()
-    dflist = []
-    for file in file_list:
-        dflist.append(pd.read_csv(file,usecols=[0,1],index_col=0,parse_dates=True,skipinitialspace=True))
-    df = pd.concat(dflist)
+    df = None
+    if pads is not None and file_list:
+        # column types are given explicitly so that a first file with no
+        # data (an all-empty column) does not make pyarrow infer a null type
+        with open(file_list[0]) as f:
+            names = f.readline().rstrip('\r\n').split(',')
+        try:
+            dataset = pads.dataset(file_list,format=pads.CsvFileFormat(
+                parse_options=pacsv.ParseOptions(ignore_empty_lines=True),
+                convert_options=pacsv.ConvertOptions(
+                    column_types={names[0]:pa.timestamp('s'),names[1]:pa.float32()})))
+            tbl = dataset.to_table(columns=names[:2])
+        except pa.ArrowInvalid:
+            pass
+        else:
+            df = tbl.to_pandas()
+            # match pandas column names (skipinitialspace=True)
+            df.columns = [name.strip() for name in df.columns]
+            df = df.set_index(df.columns[0])
+    if df is None:
+        df = pd.concat(
+            pd.read_csv(file,usecols=[0,1],index_col=0,parse_dates=True,
+                        skipinitialspace=True,dtype={1:'float32'},cache_dates=True)
+            for file in file_list)
+    # same index resolution whichever reader was used
+    df.index = df.index.astype('datetime64[ns]')
     return df
 
 if __name__ == '__main__':
     # Test download of 6-min csv files
-    import shutil
     os.mkdir('tmp_csv_download')
     download_multimonth_csv('tmp_csv_download', 2017, 11, 2018, 1, '9413450')
     os.listdir('tmp_csv_download')